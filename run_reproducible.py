@@ -8,9 +8,21 @@ from subprocess import PIPE
 from sys import argv as args
 from sys import exit
 import sys
+import os
 from os import path
 from itertools import islice, imap, repeat
 
+import errno
+import fcntl
+import re
+import tempfile
+import time
+
+import shutil
+import threading
+from collections import defaultdict
+from distutils.spawn import find_executable
+
 ### Helper functions
 # Make a function that prints to to the given file.
 mkfprint = lambda f: lambda *args, **kwargs: print(*args, file=f, **kwargs)
@@ -21,10 +33,392 @@ equals_any = lambda v, l: any(imap(lambda x: v == x, l))
 
 default_reproducible_path = ".reproducible"
 
+### Job slots
+# Concurrent invocations of the runners on the same machine share a pool of job slots: a step waits
+# for a slot before it is launched. The pool is either the jobserver of a parent ``make -j'', or a
+# local one made of lock files, one per slot.
+
+# Environment variable holding the jobserver specification to use when none is given on the command
+# line. See make_jobserver.
+JOBSERVER_ENV = "REPRODUCIBLE_JOBSERVER"
+# Environment variable set for a child launched while holding a job slot. The child may use that slot,
+# just like a ``make'' child uses the slot its parent acquired to run it.
+JOBSERVER_HELD_ENV = "REPRODUCIBLE_JOBSERVER_HELD"
+# How often, in seconds, a runner waiting for a job slot checks whether one has become free.
+JOBSERVER_POLL_INTERVAL = 0.1
+
+class JobServer:
+    """ A pool of job slots. Subclasses implement _try_acquire_token and _release_token; the implicit slot is
+        the one this process holds by virtue of having been launched by a runner that acquired it.
+        """
+    IMPLICIT = "implicit"
+
+    def __init__(self, implicit_slot=False):
+        self.implicit_free = implicit_slot
+
+    def try_acquire(self):
+        """ Acquire a slot without waiting, returning a token to give back to release, or None if all
+            the slots are taken.
+            """
+        if self.implicit_free:
+            self.implicit_free = False
+            return self.IMPLICIT
+        return self._try_acquire_token()
+
+    def acquire(self):
+        """ Acquire a slot, waiting for one to become free if need be. """
+        token = self.try_acquire()
+        if token is None:
+            errprint("Waiting for a job slot...")
+        while token is None:
+            time.sleep(JOBSERVER_POLL_INTERVAL)
+            token = self.try_acquire()
+        return token
+
+    def release(self, token):
+        if token == self.IMPLICIT:
+            self.implicit_free = True
+        else:
+            self._release_token(token)
+
+    def child_env(self):
+        """ The environment to launch a child with while holding a slot on its behalf, or None to
+            simply inherit this process' environment.
+            """
+        return None
+
+class NullJobServer(JobServer):
+    """ An unbounded pool of slots, used when no jobserver is configured. """
+    def _try_acquire_token(self):
+        return True
+
+    def _release_token(self, token):
+        pass
+
+class MakeJobServer(JobServer):
+    """ The jobserver of a parent GNU make, as advertised in MAKEFLAGS. Each token is a byte read from
+        the jobserver's pipe (or fifo), which must be written back to release the slot. As with any
+        make child, this process holds one implicit slot.
+        """
+    def __init__(self, auth):
+        JobServer.__init__(self, implicit_slot=True)
+        if auth.startswith("fifo:"):
+            fifo_path = auth[len("fifo:"):]
+            self.read_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+            self.write_fd = os.open(fifo_path, os.O_WRONLY)
+        else:
+            read_fd, write_fd = map(int, auth.split(","))
+            # the pipe is only passed down if the recipe is marked with ``+'' or runs $(MAKE).
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+            # reopen the read end, so as to make it non-blocking without affecting make's own.
+            self.read_fd = os.open("/proc/self/fd/%i" % read_fd, os.O_RDONLY | os.O_NONBLOCK)
+            self.write_fd = write_fd
+        fcntl.fcntl(self.read_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    @staticmethod
+    def find_auth(makeflags):
+        """ Extract the jobserver authorization from the given MAKEFLAGS, or None if there is none. """
+        matches = re.findall(r"--jobserver-(?:auth|fds)=(\S+)", makeflags)
+        return matches[-1] if matches else None
+
+    def _try_acquire_token(self):
+        try:
+            return os.read(self.read_fd, 1) or None
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            raise
+
+    def _release_token(self, token):
+        os.write(self.write_fd, token)
+
+class LocalJobServer(JobServer):
+    """ A standalone pool of job slots shared by all the runners using the same directory. The directory
+        holds one lock file per slot, and a slot is held for as long as its file is locked, so that the
+        slots of a runner that dies are released along with it.
+        """
+    def __init__(self, directory, slots, implicit_slot=False):
+        JobServer.__init__(self, implicit_slot)
+        self.directory = directory
+        self.slots     = slots
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def default_directory():
+        return path.join(tempfile.gettempdir(), "reproducible-jobserver-%i" % os.getuid())
+
+    def _try_acquire_token(self):
+        for i in xrange(self.slots):
+            f = open(path.join(self.directory, "slot-%i" % i), 'a')
+            # children must not inherit the lock, lest the slot stay taken until they all exit.
+            fcntl.fcntl(f, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except IOError as e:
+                f.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+        return None
+
+    def _release_token(self, token):
+        token.close() # closing the file releases the lock
+
+    def child_env(self):
+        env = dict(os.environ)
+        env[JOBSERVER_ENV] = "%s:%i" % (self.directory, self.slots)
+        env[JOBSERVER_HELD_ENV] = "1"
+        return env
+
+def make_jobserver(spec=None):
+    """ Construct the jobserver described by the given specification, which is one of
+          * ``none'': do not limit the number of jobs;
+          * ``make'': use the jobserver of the parent make, as advertised in MAKEFLAGS;
+          * N: use a local jobserver with N slots, in a directory shared by all of the user's runners;
+          * DIR:N: use a local jobserver with N slots in the directory DIR.
+        If no specification is given, the one in the REPRODUCIBLE_JOBSERVER environment variable is used;
+        failing that, the jobserver of the parent make if there is one, and no jobserver otherwise.
+        A ValueError is raised if the specification is invalid or the jobserver is unavailable.
+        """
+    auth = MakeJobServer.find_auth(os.environ.get("MAKEFLAGS", ""))
+    if spec is None:
+        spec = os.environ.get(JOBSERVER_ENV)
+    if spec is None:
+        if auth is None:
+            return NullJobServer()
+        try:
+            return MakeJobServer(auth)
+        except (OSError, ValueError):
+            errprint("warning: the make jobserver is unavailable; prefix the recipe with ``+''.")
+            return NullJobServer()
+
+    if spec == "none":
+        return NullJobServer()
+    if spec == "make":
+        if auth is None:
+            raise ValueError("no make jobserver advertised in MAKEFLAGS.")
+        try:
+            return MakeJobServer(auth)
+        except (OSError, ValueError) as e:
+            raise ValueError("unable to use the make jobserver ``%s'': %s" % (auth, e))
+
+    directory, sep, slots = spec.rpartition(":")
+    if not sep:
+        directory = LocalJobServer.default_directory()
+    try:
+        slots = int(slots)
+    except ValueError:
+        raise ValueError("invalid jobserver specification ``%s''." % spec)
+    if slots < 1:
+        raise ValueError("a jobserver needs at least one slot.")
+    try:
+        return LocalJobServer(directory, slots, implicit_slot=JOBSERVER_HELD_ENV in os.environ)
+    except OSError as e:
+        raise ValueError("unable to use the jobserver directory ``%s'': %s" % (directory, e))
+
+### Profiling
+# A script can be run under a profiler, the profile being saved alongside rev.txt so that it is tied to
+# the exact revision that produced it.
+
+PROFILERS = ("auto", "cprofile", "perf", "py-spy", "sample")
+# How often, in seconds, the ``sample'' profiler samples the script's processes.
+SAMPLE_INTERVAL = 0.02
+# Names of the process states found in /proc/<pid>/stat, used when a process' kernel stack is unavailable.
+PROCESS_STATES = {"R": "running", "S": "sleeping", "D": "disk-sleep", "T": "stopped",
+                  "t": "tracing-stop", "Z": "zombie", "X": "dead", "I": "idle"}
+
+# Whether perf can record, once perf_can_record has found out.
+perf_usable = None
+
+def perf_can_record():
+    """ Determine whether perf is installed and allowed to record, which it may not be, e.g. in a
+        container, or depending on /proc/sys/kernel/perf_event_paranoid, by recording a trivial command.
+        The answer is remembered, so that perf is probed at most once.
+        """
+    global perf_usable
+    if perf_usable is None:
+        perf_usable = False
+        if find_executable("perf"):
+            with open(os.devnull, 'w') as devnull:
+                try:
+                    perf_usable = subprocess.call(["perf", "record", "-q", "-o", os.devnull, "--", "true"],
+                                                  stdout=devnull, stderr=devnull) == 0
+                except OSError:
+                    pass
+    return perf_usable
+
+def python_interpreter(script_path):
+    """ The command (as a list) running the interpreter of the given script if it is a Python script,
+        as determined by its ``#!'' line or, lacking one, by its extension. None is returned otherwise.
+        """
+    try:
+        with open(script_path) as f:
+            first_line = f.readline()
+    except IOError:
+        return None
+    if first_line.startswith("#!"):
+        interpreter = first_line[2:].split()
+        if any(imap(lambda word: path.basename(word).startswith("python"), interpreter)):
+            return interpreter
+        return None
+    if script_path.endswith(".py"):
+        return [sys.executable]
+    return None
+
+class ProfileCapture:
+    """ Profile one run of a command, saving the profile in the given directory, in file(s) whose names
+        start with the given prefix. The profiler is one of
+          * ``cprofile'': Python's deterministic profiler, for Python scripts; saves a .pstats file;
+          * ``perf'': Linux's sampling profiler; saves a .perf.data file;
+          * ``py-spy'': a sampling profiler for Python, including subprocesses; saves a speedscope file;
+          * ``sample'': periodically samples the kernel stack (or, failing that, the wait channel or the
+            state) of every process of the script, by reading /proc; saves a .folded file, in the format
+            expected by flamegraph.pl.
+        ``auto'' picks cProfile for Python scripts, and otherwise perf if it is installed and able to
+        record, falling back to ``sample''. Note that ``sample'' does not see user-space stacks.
+        """
+    def __init__(self, mode, directory, prefix="profile"):
+        if mode not in PROFILERS:
+            raise ValueError("unknown profiler ``%s''." % mode)
+        self.mode      = mode
+        self.directory = directory
+        self.prefix    = prefix
+        self.sampler   = None
+
+    def _profile_path(self, extension):
+        return path.join(self.directory, self.prefix + extension)
+
+    def wrap(self, command):
+        """ Return the command to run in place of the given one in order to profile it. """
+        interpreter = python_interpreter(command[0])
+        if self.mode == "auto":
+            if interpreter is not None:
+                self.mode = "cprofile"
+            elif perf_can_record():
+                self.mode = "perf"
+            else:
+                self.mode = "sample"
+
+        if self.mode == "cprofile":
+            if interpreter is None:
+                raise ValueError("cProfile can only profile Python scripts.")
+            return interpreter + ["-m", "cProfile", "-o", self._profile_path(".pstats")] + command
+        elif self.mode == "perf":
+            return ["perf", "record", "-g", "-q", "-o", self._profile_path(".perf.data"), "--"] + command
+        elif self.mode == "py-spy":
+            return ["py-spy", "record", "--subprocesses", "--format", "speedscope",
+                    "-o", self._profile_path(".speedscope.json"), "--"] + command
+        else:
+            return command
+
+    def start(self, proc):
+        """ Start profiling, if need be, the process launched from the wrapped command. """
+        if self.mode == "sample":
+            self.sampler = ProcessSampler(proc.pid)
+            self.sampler.start()
+
+    def stop(self):
+        """ Finish profiling, once the process launched from the wrapped command has completed. """
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.save(self._profile_path(".folded"))
+            self.sampler = None
+
+    def save_to(self, rev_folder):
+        """ Move the profile, captured in a scratch directory, into the given one. """
+        for name in os.listdir(self.directory):
+            if name.startswith(self.prefix):
+                shutil.move(path.join(self.directory, name), path.join(rev_folder, name))
+
+class ProcessSampler(threading.Thread):
+    """ Periodically sample what a process and its descendants are doing, by reading /proc. Each sample
+        is the process' name followed by its kernel stack if it is readable (it generally requires
+        root), or else its wait channel, or else its state.
+        """
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon   = True
+        self.pid      = pid
+        self.interval = interval
+        self.counts   = defaultdict(int)
+        self.stopped  = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for pid in self._process_tree():
+                frames = self._frames(pid)
+                if frames is not None:
+                    self.counts[frames] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def save(self, profile_path):
+        try:
+            with open(profile_path, 'w') as f:
+                fprint = mkfprint(f)
+                for frames, count in sorted(self.counts.iteritems(), key=lambda item: -item[1]):
+                    fprint("%s %i" % (";".join(frames), count))
+        except IOError as e:
+            errprint("warning: unable to save the profile: %s" % str(e))
+
+    def _process_tree(self):
+        pids = [self.pid]
+        i = 0
+        while i < len(pids):
+            task_dir = "/proc/%i/task" % pids[i]
+            try:
+                for tid in os.listdir(task_dir):
+                    with open(path.join(task_dir, tid, "children")) as f:
+                        pids.extend(imap(int, f.read().split()))
+            except (IOError, OSError):
+                pass # the process has exited, or children are not available on this kernel
+            i += 1
+        return pids
+
+    @staticmethod
+    def _frames(pid):
+        proc_dir = "/proc/%i" % pid
+        try:
+            with open(path.join(proc_dir, "stat")) as f:
+                stat = f.read()
+            name = stat[stat.index("(") + 1:stat.rindex(")")]
+            state = stat[stat.rindex(")") + 2]
+            if state == "Z":
+                return None
+            try:
+                with open(path.join(proc_dir, "stack")) as f:
+                    # lines look like ``[<0>] do_wait+0x1a/0x30''; the innermost frame comes first.
+                    stack = [line.split()[1].split("+")[0] for line in f if len(line.split()) > 1]
+            except (IOError, OSError):
+                stack = []
+            if stack:
+                return tuple([name] + stack[::-1])
+            with open(path.join(proc_dir, "wchan")) as f:
+                wchan = f.read().strip()
+            if wchan and wchan != "0":
+                return (name, wchan)
+            return (name, PROCESS_STATES.get(state, state))
+        except (IOError, OSError, ValueError):
+            return None # the process has exited
+
 def run_reproducible(script_command, force=False, rev_folder=None,
-        reproducible_path=default_reproducible_path, history_back_n=5):
+        reproducible_path=default_reproducible_path, history_back_n=5, jobserver=None,
+        profiler=None):
     if reproducible_path == None:
         reproducible_path = default_reproducible_path
+    if jobserver == None:
+        jobserver = NullJobServer()
+    if profiler != None and profiler not in PROFILERS:
+        map(errprint, ["fatal: unknown profiler ``%s''." % profiler,
+                       "Please specify one of: %s." % ", ".join(PROFILERS)])
+        return 1
 
     files = []
 
@@ -95,25 +489,61 @@ def run_reproducible(script_command, force=False, rev_folder=None,
         return 1
 
 
-    # run the inner script, and we'll collect its stdout.
+    # the output directory may not be known until the inner script completes, so the profile is
+    # captured in a scratch directory and moved alongside rev.txt afterwards.
+    capture = None
+    command = script_command
+    if profiler != None:
+        capture = ProfileCapture(profiler, tempfile.mkdtemp(prefix="reproducible-profile-"))
+        try:
+            command = capture.wrap(script_command)
+        except ValueError as e:
+            map(errprint, ["fatal: unable to profile the inner script.", str(e)])
+            shutil.rmtree(capture.directory)
+            return 1
+
     try:
-        script_proc = subprocess.Popen(script_command, stdout=PIPE)
-    except Exception as e:
-        map(errprint, ["fatal: the inner script failed to start",
-                       "Possible causes include but are not limited to:",
-                       "\t* the script not being executable.",
-                       "\t* running a script not in $PATH without the ``./'' prefix."
-                       "",
-                       "Inner exception message: %s" % str(e)])
-        return 1
+        status = run_inner_script(command, script_command, capture, rev_folder, clean,
+                                  rev_out, log_out, jobserver)
+    finally:
+        if capture != None:
+            shutil.rmtree(capture.directory, ignore_errors=True)
+    return status
+
+def run_inner_script(command, script_command, capture, rev_folder, clean, rev_out, log_out,
+                     jobserver):
+    """ Run the inner script, by way of the given command, which may wrap it in a profiler, and record
+        the reproducibility information in the output directory, along with the profile if there is
+        one. The return value is the exit code of run_reproducible.
+        """
+    # wait for a job slot, then run the inner script, and we'll collect its stdout.
+    slot = jobserver.acquire()
+    try:
+        try:
+            script_proc = subprocess.Popen(command, stdout=PIPE, env=jobserver.child_env())
+        except Exception as e:
+            map(errprint, ["fatal: the inner script failed to start",
+                           "Possible causes include but are not limited to:",
+                           "\t* the script not being executable.",
+                           "\t* running a script not in $PATH without the ``./'' prefix."
+                           "",
+                           "Inner exception message: %s" % str(e)])
+            return 1
 
-    while True:
-        line = script_proc.stdout.readline()
-        if not line:
-            break
-        sys.stdout.write(line) # echo everything the internal script outputs.
-        last_line = line # remember the last line emitted on stdout
-    script_proc.wait() # the stdout is closed, but the process may still be running.
+        if capture != None:
+            capture.start(script_proc)
+        last_line = None
+        while True:
+            line = script_proc.stdout.readline()
+            if not line:
+                break
+            sys.stdout.write(line) # echo everything the internal script outputs.
+            last_line = line # remember the last line emitted on stdout
+        script_proc.wait() # the stdout is closed, but the process may still be running.
+        if capture != None:
+            capture.stop()
+    finally:
+        jobserver.release(slot)
 
     if script_proc.returncode != 0:
         map(errprint, ["fatal: the inner script returned a nonzero exit code.",
@@ -165,6 +595,13 @@ def run_reproducible(script_command, force=False, rev_folder=None,
         map(errprint, ["warning: unable to write history.",
                        "Inner exception: %s" % str(e)])
 
+    if capture != None:
+        try:
+            capture.save_to(rev_folder)
+        except (IOError, OSError) as e:
+            map(errprint, ["warning: unable to save the profile.",
+                           "Inner exception: %s" % str(e)])
+
     return 0
 
 if __name__ == "__main__":
@@ -173,6 +610,8 @@ if __name__ == "__main__":
     reproducible_path   = None
     force               = False
     history_back_n      = 5
+    jobserver_spec      = None
+    profiler            = None
 
     try: # parse the command line arguments
         i = 1
@@ -193,6 +632,18 @@ if __name__ == "__main__":
                 elif any_of(["-n", "--history"]):
                     history_back_n = int(next_arg())
                     i += 1
+                elif any_of(["-J", "--jobserver"]):
+                    jobserver_spec = next_arg()
+                    i += 1
+                elif any_of(["--profile"]):
+                    if profiler != None: # --profile and --profiler are mutually exclusive
+                        raise ValueError("both --profile and --profiler given")
+                    profiler = "auto"
+                elif any_of(["--profiler"]):
+                    if profiler != None:
+                        raise ValueError("both --profile and --profiler given")
+                    profiler = next_arg()
+                    i += 1
                 else: # if we fail to parse the args, then the script name has appeared on the command line
                     script_args.append(arg) # so we set the script name, which causes all subsequent args to be stored and passed to the inner script
             else: # if the script is defined, then all subsequent args are passed as args to the script
@@ -202,4 +653,11 @@ if __name__ == "__main__":
         errprint("fatal: invalid command line.")
         exit(1)
 
-    exit(run_reproducible(script_args, force, rev_folder, reproducible_path, history_back_n))
+    try:
+        jobserver = make_jobserver(jobserver_spec)
+    except ValueError as e:
+        errprint("fatal: %s" % str(e))
+        exit(1)
+
+    exit(run_reproducible(script_args, force, rev_folder, reproducible_path, history_back_n,
+                          jobserver, profiler))
@@ -18,8 +18,38 @@ from itertools import islice, imap, ifilter
 
 from shutil import rmtree
 
+from run_reproducible import make_jobserver, NullJobServer, ProfileCapture, PROFILERS
+
+import time
+
+import json
+from datetime import timedelta
+
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+import shutil
+import stat
+import zipfile
+
+import fcntl
+
 GIT_PATH = "/usr/bin/git"
 
+# How often, in seconds, running shards are checked for completion.
+SHARD_POLL_INTERVAL = 0.1
+
+# Name of the file, inside the results directory, recording how long each step took.
+DURATIONS_FILE = ".durations"
+
+# Size, in bytes, of the blocks in which files are read when hashing them.
+HASH_BLOCK_SIZE = 1 << 20
+
+# Suffix of the pack file into which a run is archived, next to the run's directory.
+PACK_SUFFIX = ".pack"
+# How many symlinks to previous runs are followed when looking for a step's output.
+MAX_LINK_DEPTH = 64
+
 compose = lambda f, g: lambda *args, **kwargs: f(g(*args, **kwargs))
 mkfprint = lambda f: lambda *args, **kwargs: print(*args, file=f, **kwargs)
 errprint = mkfprint(sys.stderr)
@@ -44,6 +74,12 @@ class PipelineRunnerRepositoryError(PipelineRunnerInitializationError):
 class PipelineRunnerRuntimeError(PipelineRunnerError):
     pass
 
+class RunDiffError(Exception):
+    pass
+
+class RunArchiveError(Exception):
+    pass
+
 class PipelineStepError(Exception):
     pass
 class PipelineStepInitializationError(Exception):
@@ -51,15 +87,92 @@ class PipelineStepInitializationError(Exception):
 class PipelineStepRuntimeError(Exception):
     pass
 
+class StepDurations:
+    """ A small persistent store of how long steps took, saved as JSON in the results directory.
+        Durations are keyed by the name of the step (or of a shard of a step) and by the blob hash
+        of the step's script, so that changing a script starts its history afresh.
+        """
+    def __init__(self, db_path):
+        self.db_path  = db_path
+        self.entries  = self._load()
+        self.recorded = {} # the entries recorded by this runner, to be saved
+
+    @staticmethod
+    def _key(name, blob):
+        return "%s %s" % (name, blob)
+
+    def _load(self):
+        if not path.exists(self.db_path):
+            return {}
+        try:
+            with open(self.db_path) as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            errprint("warning: unable to read step durations from ``%s'': %s" % (self.db_path, e))
+            return {}
+
+    def get(self, name, blob):
+        """ The last recorded duration in seconds of the given step, or None if there is none. """
+        if blob is None:
+            return None
+        return self.entries.get(self._key(name, blob))
+
+    def record(self, name, blob, seconds):
+        if blob is not None:
+            self.entries[self._key(name, blob)] = seconds
+            self.recorded[self._key(name, blob)] = seconds
+
+    def save(self):
+        """ Write the durations recorded by this runner back to disk, keeping whatever other runners
+            have recorded in the meantime. Concurrent runners take turns, by locking a file next to
+            the durations, and the durations are replaced atomically, so that a reader never sees
+            them half written.
+            """
+        tmp_path = "%s.%i" % (self.db_path, os.getpid())
+        try:
+            with open(self.db_path + ".lock", 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX) # released when the file is closed
+                entries = self._load()
+                entries.update(self.recorded)
+                with open(tmp_path, 'w') as f:
+                    json.dump(entries, f, indent=0, sort_keys=True)
+                os.rename(tmp_path, self.db_path)
+            self.entries = entries
+        except (IOError, OSError) as e:
+            errprint("warning: unable to save step durations to ``%s'': %s" % (self.db_path, e))
+
+def format_duration(seconds):
+    return str(timedelta(seconds=int(round(seconds))))
+
 class PipelineStep:
-    def __init__(self, name, script_path, results_dir):
-        self.name        = name
-        self.script_path = script_path
-        self.results_dir = results_dir
-        self.output_dir  = None
+    def __init__(self, name, script_path, results_dir, shards=1, merge_script_path=None,
+            jobs=1, retries=0, blob=None, durations=None, on_progress=None, jobserver=None,
+            profiler=None):
+        self.name              = name
+        self.script_path       = script_path
+        self.results_dir       = results_dir
+        self.output_dir        = None
+        self.shards            = shards
+        self.merge_script_path = merge_script_path
+        self.jobs              = jobs
+        self.retries           = retries
+        self.blob              = blob # the git blob hash of the script
+        self.durations         = durations
+        # called with the estimated number of seconds left in this step whenever a shard completes
+        self.on_progress       = on_progress
+        self.jobserver         = jobserver if jobserver is not None else NullJobServer()
+        self.profiler          = profiler # if set, the profiler to run the scripts under
+        # the time, in seconds, the last run of this step spent running, not counting any wait for a
+        # job slot before the step's first script or its merge script starts
+        self.duration          = None
 
         if not path.exists(self.script_path):
             raise PipelineStepInitializationError("File not found: %s" % self.script_path)
+        if self.merge_script_path is not None and not path.exists(self.merge_script_path):
+            raise PipelineStepInitializationError("File not found: %s" % self.merge_script_path)
+        if self.shards < 1:
+            raise PipelineStepInitializationError("Pipeline step ``%s'' must have at least one shard."
+                    % self.name)
         # we don't need to check results_dir since it is already guaranteed to exist at this point.
         # TODO perhaps check results_dir for robustness
 
@@ -67,6 +180,28 @@ class PipelineStep:
         self.output_dir = path.join(self.results_dir, run_name, self.name)
         os.makedirs(self.output_dir)
 
+    def shard_output_directory(self, index):
+        """ The subdirectory of this step's output directory in which the shard with the given
+            index stores its output.
+            """
+        return path.join(self.output_dir, "shard-%i" % index)
+
+    def shard_name(self, index):
+        return "%s/shard-%i" % (self.name, index)
+
+    def expected_duration(self):
+        """ The duration in seconds of the last run of this step with the same script, or None if
+            this is unknown.
+            """
+        if self.durations is None:
+            return None
+        return self.durations.get(self.name, self.blob)
+
+    def _expected_shard_duration(self, index):
+        if self.durations is None:
+            return None
+        return self.durations.get(self.shard_name(index), self.blob)
+
     def run(self):
         """ Run this step of the pipeline. The output directory and the previous step symlinks must be
             created prior to calling this method.
@@ -76,21 +211,189 @@ class PipelineStep:
                     % self.name)
         # output_dir is the path (relative to CWD !) where this step should store its output.
         # it is passed as the first argument to this step's inner script.
+        self.duration = 0
         try:
-            returncode = sp.call([self.script_path, self.output_dir])
-            if returncode != 0:
-                raise PipelineStepRuntimeError("The inner script failed.")
+            if self.shards == 1:
+                returncode = self._call_with_slot([self.script_path, self.output_dir],
+                        self._profile_capture(self.output_dir))
+                if returncode != 0:
+                    raise PipelineStepRuntimeError("The inner script failed.")
+            else:
+                self._run_shards()
+                if self.merge_script_path is not None:
+                    returncode = self._call_with_slot([self.merge_script_path, self.output_dir],
+                            self._profile_capture(self.output_dir, "merge-profile"))
+                    if returncode != 0:
+                        raise PipelineStepRuntimeError("The merge script failed.")
         except:
             self.exc_info = sys.exc_info()
             rmtree(self.output_dir)
             raise
 
+    def _profile_capture(self, directory, prefix="profile"):
+        """ The ProfileCapture saving the profile of a script writing its output to the given directory,
+            or None if the scripts are not profiled.
+            """
+        if self.profiler is None:
+            return None
+        return ProfileCapture(self.profiler, directory, prefix)
+
+    def _wrap_command(self, command, capture):
+        if capture is None:
+            return command
+        try:
+            return capture.wrap(command)
+        except ValueError as e:
+            raise PipelineStepRuntimeError("Unable to profile step ``%s'': %s" % (self.name, e))
+
+    def _call_with_slot(self, command, capture=None):
+        """ Wait for a job slot, then run the given command, under the profiler of the given capture if
+            there is one, returning its exit code.
+            """
+        command = self._wrap_command(command, capture)
+        slot = self.jobserver.acquire()
+        started = time.time()
+        try:
+            proc = sp.Popen(command, env=self.jobserver.child_env())
+            if capture is not None:
+                capture.start(proc)
+            returncode = proc.wait()
+            if capture is not None:
+                capture.stop()
+            return returncode
+        finally:
+            self.duration += time.time() - started
+            self.jobserver.release(slot)
+
+    def _run_shards(self):
+        """ Run every shard of this step, with at most self.jobs shards running at any given time.
+            Each shard waits for a job slot before it is started, and is given its own output
+            directory, followed by its index and the total number
+            of shards, as command-line arguments. A shard that fails is retried, from an empty output
+            directory, up to self.retries times; the other shards are unaffected. If a shard fails
+            for good, no new shards are started, the running ones are waited for, and an exception
+            is raised.
+            Shards are started longest first according to their recorded durations, those without
+            any history being started before all others.
+            """
+        pending  = sorted(xrange(self.shards), key=self._shard_priority)
+        attempts = dict.fromkeys(pending, 0)
+        running  = {} # maps the Popen object of each running shard to its index
+        slots    = {} # maps the Popen object of each running shard to the job slot it holds
+        captures = {} # maps the Popen object of each running shard to its profile capture
+        started  = {} # maps the index of each running shard to the time it was started
+        failed   = []
+
+        first_started = None
+        spare_slot = None
+        try:
+            while running or (pending and not failed):
+                while pending and not failed and len(running) < self.jobs:
+                    slot = self.jobserver.try_acquire()
+                    if slot is None:
+                        break
+                    spare_slot = slot # held, but not yet by a running shard
+                    if first_started is None:
+                        first_started = time.time()
+                    index = pending.pop(0)
+                    shard_dir = self.shard_output_directory(index)
+                    if path.exists(shard_dir): # left behind by a failed attempt
+                        rmtree(shard_dir)
+                    os.makedirs(shard_dir)
+                    attempts[index] += 1
+                    capture = self._profile_capture(shard_dir)
+                    try:
+                        command = self._wrap_command(
+                                [self.script_path, shard_dir, str(index), str(self.shards)], capture)
+                        proc = sp.Popen(command, env=self.jobserver.child_env())
+                    except (OSError, PipelineStepRuntimeError) as e:
+                        spare_slot = None
+                        self.jobserver.release(slot)
+                        errprint("Shard #%i of step ``%s'' failed to start: %s" % (index, self.name, e))
+                        failed.append(index)
+                        break
+                    running[proc] = index
+                    slots[proc] = slot
+                    spare_slot = None
+                    captures[proc] = capture
+                    if capture is not None:
+                        capture.start(proc)
+                    started[index] = time.time()
+
+                time.sleep(SHARD_POLL_INTERVAL)
+
+                for proc, index in running.items():
+                    if proc.poll() is None:
+                        continue
+                    del running[proc]
+                    self.jobserver.release(slots.pop(proc))
+                    capture = captures.pop(proc)
+                    if capture is not None:
+                        capture.stop()
+                    if proc.returncode == 0:
+                        if self.durations is not None and self.profiler is None:
+                            self.durations.record(self.shard_name(index), self.blob,
+                                    time.time() - started[index])
+                            self.durations.save() # kept even if another shard fails
+                        if self.on_progress is not None:
+                            self.on_progress(self._estimate_remaining(pending, running, started))
+                        continue
+                    del started[index]
+                    if attempts[index] <= self.retries:
+                        errprint("Shard #%i of step ``%s'' failed; retrying." % (index, self.name))
+                        pending.insert(0, index)
+                    else:
+                        failed.append(index)
+        finally:
+            # only reached with slots still held if the loop was escaped, e.g. by an interrupt: the
+            # step is abandoned, so its shards are stopped, and no slot may be kept from others.
+            for proc in slots.keys():
+                if proc.poll() is None:
+                    proc.terminate()
+                    proc.wait()
+                if captures.get(proc) is not None:
+                    captures[proc].stop()
+                self.jobserver.release(slots.pop(proc))
+            if spare_slot is not None:
+                self.jobserver.release(spare_slot)
+            if first_started is not None:
+                self.duration += time.time() - first_started
+
+        if failed:
+            raise PipelineStepRuntimeError("The inner script failed for shard(s) %s."
+                    % ", ".join(imap(str, sorted(failed))))
+
+    def _shard_priority(self, index):
+        """ Sort key putting the shards expected to take the longest first. """
+        expected = self._expected_shard_duration(index)
+        return (expected is not None, -(expected or 0), index)
+
+    def _estimate_remaining(self, pending, running, started):
+        """ Estimate how many seconds are left before all the shards complete, assuming the work
+            left is spread evenly over as many jobs as there are shards left, up to self.jobs; the
+            estimate is never less than the longest of those shards. Returns None if any shard has
+            no history.
+            """
+        now = time.time()
+        left = pending + running.values()
+        if not left:
+            return 0
+        total = longest = 0
+        for index in left:
+            expected = self._expected_shard_duration(index)
+            if expected is None:
+                return None
+            remaining = max(expected - (now - started[index]), 0) if index in started else expected
+            total += remaining
+            longest = max(longest, remaining)
+        return max(total / float(min(self.jobs, len(left))), longest)
+
 class PipelineRunner:
     def __init__(self, force=False, final=False, output_dir=None,
             results_dir="results", reproducible_list_file=".reproducible",
             pipeline_file=".pipeline", range_start=None, range_end=None,
             future=False, previous_run=None, ignore_missing_output=False,
-            inference_behaviour=None):
+            inference_behaviour=None, jobs=1, retries=0, jobserver_spec=None, profiler=None):
         self.force                  = force
         self.output_dir             = output_dir
         self.results_dir            = results_dir
@@ -103,6 +406,9 @@ class PipelineRunner:
         self.inference_behaviour    = inference_behaviour
         self.final                  = final
         self.future                 = future
+        self.jobs                   = jobs
+        self.retries                = retries
+        self.profiler               = profiler
 
         if not path.exists(self.results_dir):
             raise PipelineRunnerInitializationError("Results directory does not exist: %s"
@@ -115,10 +421,24 @@ class PipelineRunner:
             raise PipelineRunnerInitializationError(
                     "fatal: no pipeline specification file named ``%s'' present"
                     % self.pipeline_file)
-        if self.previous_run and not path.exists(path.join(self.results_dir, self.previous_run)):
+        if self.previous_run and not RunArchive(path.join(self.results_dir, self.previous_run)).exists():
             raise PipelineRunnerInitializationError("Previous run directory not found: %s"
                     % path.join(self.results_dir, self.previous_run))
 
+        if self.jobs < 1:
+            raise PipelineRunnerInitializationError("fatal: the number of jobs must be positive.")
+        if self.retries < 0:
+            raise PipelineRunnerInitializationError("fatal: the number of retries must not be negative.")
+
+        if self.profiler is not None and self.profiler not in PROFILERS:
+            raise PipelineRunnerInitializationError("fatal: unknown profiler ``%s''; expected one of %s."
+                    % (self.profiler, ", ".join(PROFILERS)))
+
+        try:
+            self.jobserver = make_jobserver(jobserver_spec)
+        except ValueError as e:
+            raise PipelineRunnerInitializationError("fatal: %s" % e)
+
         if self.output_dir is None:
             t = datetime.now()
             self.output_dir = str(t)
@@ -135,6 +455,8 @@ class PipelineRunner:
                         "fatal: repository is not clean. \nPlease commit changes to any files "
                         + "listed in ``%s''." % self.reproducible_list_file)
 
+        self.durations = StepDurations(path.join(self.results_dir, DURATIONS_FILE))
+
         self._parse_pipeline_file() # also verifies that the scripts exist
 
         self._determine_range()
@@ -154,9 +476,18 @@ class PipelineRunner:
         if self.range_start > 0:
             self._generate_previous_step_links()
 
-        for step in islice(self.pipeline_steps, self.range_start, self.range_end + 1):
+        steps = self.pipeline_steps[self.range_start:self.range_end + 1]
+        for (i, step) in enumerate(steps):
+            later_steps = steps[i + 1:]
+            step.on_progress = lambda seconds: self._print_eta([seconds] +
+                    [s.expected_duration() for s in later_steps])
+            self._print_eta([s.expected_duration() for s in steps[i:]])
+
             step.make_output_directory(self.output_dir)
             step.run()
+            if self.profiler is None: # profiling overhead would skew the estimates of later runs
+                self.durations.record(step.name, step.blob, step.duration)
+                self.durations.save()
 
         odir = path.join(self.results_dir, self.output_dir)
         with open(path.join(odir, "rev.txt"), 'w') as f:
@@ -165,6 +496,22 @@ class PipelineRunner:
             with open(path.join(odir, ".final"), 'w') as f:
                 mkfprint(f)("final")
 
+    @staticmethod
+    def _print_eta(expected_durations):
+        """ Print an estimate of when the run will complete, given the expected durations in seconds
+            of the work remaining, None standing for work without any recorded history.
+            """
+        known = [d for d in expected_durations if d is not None]
+        unknown = len(expected_durations) - len(known)
+        if not known:
+            print("ETA: unknown (no recorded durations for the remaining steps)")
+            return
+        remaining = sum(known)
+        finish = datetime.now() + timedelta(seconds=remaining)
+        print("ETA: %s remaining, finishing around %s%s" % (format_duration(remaining),
+                finish.strftime("%H:%M:%S"),
+                " (not counting %i step(s) without history)" % unknown if unknown else ""))
+
     def _generate_previous_step_links(self):
         """ For each step N from the previous run where N < self.range_start, generate a symlink
             to that step's output folder in this run's folder.
@@ -329,52 +676,69 @@ class PipelineRunner:
     @staticmethod
     def _is_final(run_dir):
         """ Determine whether the run saved to the given directory is final, i.e. if it contains a file
-            named ``.final''.
+            named ``.final''. The run may have been archived.
             """
-        return ".final" in os.listdir(run_dir)
+        with RunArchive(run_dir) as archive:
+            return ".final" in archive.entries()
 
     @staticmethod
     def _is_reproducible(run_dir):
-        """ Determine whether a given run is reproducible, i.e. check for the existence of a rev.txt. """
-        return "rev.txt" in os.listdir(run_dir)
+        """ Determine whether a given run is reproducible, i.e. check for the existence of a rev.txt.
+            The run may have been archived.
+            """
+        with RunArchive(run_dir) as archive:
+            return "rev.txt" in archive.entries()
 
     def _count_steps_in_run(self, run_name):
         """ Determine how many steps there are in a run by counting the number of folders in that
-            directory whose names are step names as listed in self.pipeline_file.
+            directory whose names are step names as listed in self.pipeline_file. Steps that were
+            archived, and symlinks to steps of runs that were archived, count as well.
             """
         stepnames = map(lambda step: step.name, self.pipeline_steps)
         odir = path.join(self.results_dir, run_name)
-        return len(filter(lambda p: path.isdir(p) and (path.basename(p) in stepnames),
-                          map(lambda p: path.join(odir, p), os.listdir(odir))))
+        with RunArchive(odir) as archive:
+            entries = archive.entries()
+        packed = entries - (set(os.listdir(odir)) if path.isdir(odir) else set())
+        return len(filter(lambda p: (path.isdir(p) or path.islink(p) or path.basename(p) in packed)
+                                    and (path.basename(p) in stepnames),
+                          map(lambda p: path.join(odir, p), entries)))
+
+    def _list_runs(self):
+        """ List the paths to the directories of the non-final and reproducible runs, whether they
+            were archived or not, from the least to the most recently modified.
+            """
+        names = set(imap(lambda p: p[:-len(PACK_SUFFIX)] if p.endswith(PACK_SUFFIX) else p,
+                         os.listdir(self.results_dir)))
+        runs = [] # pairs of the modification time and the path of each run
+        for run_dir in imap(lambda p: path.join(self.results_dir, p), names):
+            with RunArchive(run_dir) as archive: # so that each pack is opened only once
+                if not archive.exists():
+                    continue
+                entries = archive.entries()
+                if ".final" not in entries and "rev.txt" in entries: # see _is_final, _is_reproducible
+                    runs.append((archive.mtime(), run_dir))
+        return [run_dir for (mtime, run_dir) in sorted(runs)]
 
     def _determine_previous_run(self):
         """ Figure out what the previous run is by taking the most recent non-final and reproducible
             run directory's name. If there are no such runs, then False is returned. True is
             returned if self.previous_run was successfully set to the run name of an appropriate
             previous run. """
-        # get the list of runs as an iterable, ignoring any files in the results directory that are not
-        # folders, ignoring any runs that are final, and ignoring any runs which themselves are not
-        # reproducible.
-        runs = filter(lambda p: path.isdir(p) and not self._is_final(p) and self._is_reproducible(p),
-                imap(lambda p: path.join(self.results_dir, p), os.listdir(self.results_dir)))
-        if len(runs) == 0:
+        # get the list of runs, ignoring any files in the results directory that are neither folders
+        # nor packs, ignoring any runs that are final, and ignoring any runs which themselves are not
+        # reproducible, sorted by last modification time.
+        sorted_runs = self._list_runs() # the last entry is the most recent
+        if len(sorted_runs) == 0:
             return False
-        # runs now contains a list of paths to run directories. We need to sort by last modification time
-        sorted_runs = sorted(runs, key=path.getmtime) # the last entry is the most recent
         self.previous_run = path.basename(sorted_runs[-1]) # return the basename, since that is the run name.
         return True
 
     # TODO store all these previous runs that way when we want to query, we don't need to regenerate this list.
     def _find_previous_run_with(self, step_name):
-        runs = filter(lambda p: path.isdir(p) and not self._is_final(p) and self._is_reproducible(p),
-                imap(lambda p: path.join(self.results_dir, p), os.listdir(self.results_dir)))
-        if len(runs) == 0:
-            return None
-
-        sorted_runs = sorted(runs, key=path.getmtime)
-        for step_path in reversed(sorted_runs):
-            if path.exists(path.join(step_path, step_name)):
-                return path.basename(step_path)
+        for step_path in reversed(self._list_runs()):
+            with RunArchive(step_path) as archive:
+                if step_name in archive.entries():
+                    return path.basename(step_path)
         return None
 
     def _parse_pipeline_file(self): # :: ... -> IO () ;)
@@ -391,21 +755,63 @@ class PipelineRunner:
                     words = line[:-1].split() # drop the last char since it's \n
                     script_rel_path = words[0]
                     step_name       = words[1]
+                    options         = self._parse_step_options(words[2:])
                     script_abs_path = self._rebase_path(self.pipeline_file, script_rel_path)
                     if not path.exists(script_abs_path):
                         raise PipelineStepInitializationError(
                                 "Cannot find pipeline component script ``%s''" % script_abs_path)
-                    step = PipelineStep(step_name, script_abs_path, self.results_dir)
+                    merge_abs_path = None
+                    if "merge" in options:
+                        merge_abs_path = self._rebase_path(self.pipeline_file, options["merge"])
+                    step = PipelineStep(step_name, script_abs_path, self.results_dir,
+                            shards=options.get("shards", 1), merge_script_path=merge_abs_path,
+                            jobs=self.jobs, retries=self.retries,
+                            blob=self._blob_hash(script_abs_path), durations=self.durations,
+                            jobserver=self.jobserver, profiler=self.profiler)
                     self.pipeline_steps.append(step)
                     lineno += 1
-        except IndexError:
+        except (IndexError, ValueError) as e:
             errprint("Invalid format at ", self.pipeline_file, ":", lineno)
+            if isinstance(e, ValueError):
+                errprint(e)
             raise PipelineRunnerInitializationError("Invalid pipeline specification.")
         except IOError as e:
             errprint("IO error:", e)
             raise PipelineRunnerInitializationError("IO error.")
         # allow other exceptions to percolate up
 
+    @staticmethod
+    def _parse_step_options(words):
+        """ Parse the optional columns following the step name in the pipeline file. Each is of the
+            form ``key=value''; the recognized keys are ``shards'', the number of shards to split the
+            step into, and ``merge'', the path (relative to the pipeline file) to a script to run once
+            all the shards have completed, which requires at least two shards. A ValueError is raised
+            for anything else.
+            """
+        options = {}
+        for word in words:
+            key, sep, value = word.partition("=")
+            if not sep or key in options:
+                raise ValueError("malformed step option ``%s''" % word)
+            if key == "shards":
+                options[key] = int(value)
+            elif key == "merge":
+                options[key] = value
+            else:
+                raise ValueError("unknown step option ``%s''" % key)
+        if "merge" in options and options.get("shards", 1) < 2:
+            raise ValueError("step option ``merge'' requires ``shards'' to be at least 2")
+        return options
+
+    @staticmethod
+    def _blob_hash(script_path):
+        """ Compute the git blob hash of the given file's current contents, or None if git fails. """
+        git_hash_proc = sp.Popen([GIT_PATH, "hash-object", script_path], stdout=PIPE)
+        git_hash_out, git_hash_err = git_hash_proc.communicate()
+        if git_hash_proc.returncode != 0:
+            return None
+        return git_hash_out.strip()
+
     def _parse_reproducible_file(self): # :: ... -> IO ()
         """ Parse self.reproducible_list_file, rebase all the paths to be relative to the CWD, and check
             that all the files exist. If any files are missing, an exception is thrown. The resulting
@@ -454,9 +860,27 @@ class PipelineRunner:
         raise ValueError("no such step named ``%s''." % step_name)
 
     def _make_previous_link(self, name):
+        self._unpack_step(self.previous_run, name)
         os.symlink(path.join("..", self.previous_run, name),
                    path.join(self.results_dir, self.output_dir, name))
 
+    def _unpack_step(self, run_name, step_name, depth=0):
+        """ Make sure that the output of the given step of the given run is present on disk, unpacking
+            the run if it was archived. If the step is a symlink to a previous run, that run is in turn
+            unpacked if need be, and so on.
+            """
+        run_dir = path.join(self.results_dir, run_name)
+        step_dir = path.join(run_dir, step_name)
+        with RunArchive(run_dir) as archive:
+            if not path.lexists(step_dir) and step_name in archive.entries():
+                print("Unpacking archived run:", run_name)
+                archive.unpack()
+        if path.islink(step_dir) and not path.exists(step_dir) and depth < MAX_LINK_DEPTH:
+            target = path.normpath(path.join(run_dir, os.readlink(step_dir)))
+            if path.dirname(path.dirname(target)) == path.normpath(self.results_dir):
+                self._unpack_step(path.basename(path.dirname(target)), path.basename(target),
+                        depth + 1)
+
     def _parse_range(self, value):
         if not isinstance(value, str):
             return value
@@ -466,6 +890,412 @@ class PipelineRunner:
         except ValueError:
             return self._resolve_id(value)
 
+class RunArchive:
+    """ A run whose files may have been packed, in part or in whole, into a single compressed pack file
+        named after the run's directory. The pack is a zip file, whose central directory indexes its
+        members, so that any one of them can be read without unpacking the rest. Symlinks are packed
+        as such. The entries of a run are the union of those in its directory and in its pack.
+        The pack is opened, and its index read, at most once for the lifetime of the object, which
+        should therefore be closed when done with.
+        """
+    def __init__(self, run_dir):
+        self.run_dir   = path.normpath(run_dir)
+        self.pack_path = self.run_dir + PACK_SUFFIX
+        self._pack     = None # the open pack, once it is needed
+        self._infos    = None # maps the name of each member of the pack, sans trailing /, to its info
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._pack is not None:
+            self._pack.close()
+        self._pack  = None
+        self._infos = None
+
+    def _index(self):
+        if self._infos is None:
+            self._infos = {}
+            if self.is_packed():
+                self._pack = zipfile.ZipFile(self.pack_path)
+                for info in self._pack.infolist():
+                    self._infos[info.filename.rstrip("/")] = info
+        return self._infos
+
+    def is_packed(self):
+        return path.isfile(self.pack_path)
+
+    def exists(self):
+        return path.isdir(self.run_dir) or self.is_packed()
+
+    def mtime(self):
+        """ The modification time of the run, which packing and unpacking preserve. """
+        return path.getmtime(self.run_dir if path.isdir(self.run_dir) else self.pack_path)
+
+    def members(self):
+        """ The paths, relative to the run directory, of the files and directories in the pack. """
+        return self._index().keys()
+
+    def member_info(self, rel_path):
+        """ The ZipInfo of the given member of the pack, or None if there is no such member. """
+        return self._index().get(rel_path)
+
+    def link_target(self, rel_path):
+        """ The target of the given member of the pack if it is a symlink, and None otherwise. """
+        info = self.member_info(rel_path)
+        if info is None or not stat.S_ISLNK(info.external_attr >> 16):
+            return None
+        return self._pack.read(info)
+
+    def entries(self):
+        """ The names of the top-level files and directories of the run, packed or not. """
+        names = set(os.listdir(self.run_dir)) if path.isdir(self.run_dir) else set()
+        names.update(member.split("/")[0] for member in self.members())
+        return names
+
+    def open(self, rel_path):
+        """ Open the given file of the run for reading, from the run directory if it is there, and
+            otherwise straight from the pack. Each member opened from the pack gets its own file
+            handle, so that several may be read at the same time, from different threads.
+            """
+        file_path = path.join(self.run_dir, rel_path)
+        if path.isfile(file_path):
+            return open(file_path, 'rb')
+        info = self.member_info(rel_path)
+        if info is not None and not info.filename.endswith("/"):
+            return self._pack.open(info)
+        raise RunArchiveError("No file ``%s'' in run ``%s''." % (rel_path, self.run_dir))
+
+    def pack(self, names=None):
+        """ Pack the given top-level entries of the run (all of them by default) into the pack, adding
+            them to whatever it already holds, then remove them from the run directory, and the
+            directory itself once it is empty. The pack is written to a temporary file first, so that
+            nothing is removed unless it was packed successfully.
+            """
+        if not path.isdir(self.run_dir):
+            raise RunArchiveError("Run directory not found: %s" % self.run_dir)
+        self.close() # the pack is about to change
+        if names is None:
+            names = sorted(os.listdir(self.run_dir))
+        mtime = self.mtime()
+
+        tmp_path = self.pack_path + ".tmp"
+        if self.is_packed():
+            shutil.copyfile(self.pack_path, tmp_path)
+        try:
+            with zipfile.ZipFile(tmp_path, 'a' if self.is_packed() else 'w', zipfile.ZIP_DEFLATED,
+                    allowZip64=True) as pack:
+                for name in names:
+                    self._pack_entry(pack, name)
+            os.rename(tmp_path, self.pack_path)
+        except:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        for name in names:
+            entry_path = path.join(self.run_dir, name)
+            if path.isdir(entry_path) and not path.islink(entry_path):
+                rmtree(entry_path)
+            else:
+                os.remove(entry_path)
+        if not os.listdir(self.run_dir):
+            os.rmdir(self.run_dir)
+        else:
+            os.utime(self.run_dir, (mtime, mtime))
+        os.utime(self.pack_path, (mtime, mtime))
+
+    def _pack_entry(self, pack, rel_path):
+        entry_path = path.join(self.run_dir, rel_path)
+        if path.islink(entry_path):
+            info = zipfile.ZipInfo(rel_path)
+            info.create_system = 3 # unix, so that the mode below is honoured
+            info.external_attr = (stat.S_IFLNK | 0o777) << 16
+            pack.writestr(info, os.readlink(entry_path))
+        elif path.isdir(entry_path):
+            st = os.stat(entry_path)
+            info = zipfile.ZipInfo(rel_path + "/", time.localtime(st.st_mtime)[:6])
+            info.create_system = 3
+            info.external_attr = (stat.S_IFDIR | stat.S_IMODE(st.st_mode)) << 16
+            pack.writestr(info, "")
+            for name in sorted(os.listdir(entry_path)):
+                self._pack_entry(pack, path.join(rel_path, name))
+        else:
+            pack.write(entry_path, rel_path)
+
+    def unpack(self):
+        """ Restore every member of the pack into the run directory, along with the modes and
+            modification times of its files and directories, then remove the pack.
+            """
+        if not self.is_packed():
+            raise RunArchiveError("Pack not found: %s" % self.pack_path)
+        self.close() # the pack is about to go away
+        mtime = self.mtime()
+        if not path.isdir(self.run_dir):
+            os.makedirs(self.run_dir)
+
+        directories = []
+        with zipfile.ZipFile(self.pack_path) as pack:
+            for info in pack.infolist():
+                rel_path = path.normpath(info.filename)
+                if path.isabs(rel_path) or rel_path.split(os.sep)[0] == "..":
+                    raise RunArchiveError("Refusing to unpack ``%s'' outside of the run directory."
+                            % info.filename)
+                dest = path.join(self.run_dir, rel_path)
+                mode = info.external_attr >> 16
+                member_mtime = time.mktime(info.date_time + (0, 0, -1)) # zip times are local
+                if stat.S_ISLNK(mode):
+                    os.symlink(pack.read(info), dest)
+                elif info.filename.endswith("/"):
+                    if not path.isdir(dest):
+                        os.makedirs(dest)
+                    directories.append((dest, mode, member_mtime))
+                else:
+                    if not path.isdir(path.dirname(dest)):
+                        os.makedirs(path.dirname(dest))
+                    with pack.open(info) as src:
+                        with open(dest, 'wb') as f:
+                            shutil.copyfileobj(src, f, HASH_BLOCK_SIZE)
+                    if stat.S_IMODE(mode):
+                        os.chmod(dest, stat.S_IMODE(mode))
+                    os.utime(dest, (member_mtime, member_mtime))
+
+        # only once their contents are restored, which would otherwise change their times (or be
+        # prevented by their modes); innermost first, for the same reason.
+        for dest, mode, dir_mtime in reversed(directories):
+            if stat.S_IMODE(mode):
+                os.chmod(dest, stat.S_IMODE(mode))
+            os.utime(dest, (dir_mtime, dir_mtime))
+
+        os.remove(self.pack_path)
+        os.utime(self.run_dir, (mtime, mtime))
+
+def find_cold_steps(results_dir, run_name):
+    """ The names of the steps of the given run that are cold, i.e. the step directories that were
+        produced by the run itself and that no other run links to. Packing them leaves no symlink of any
+        other run dangling.
+        """
+    run_dir = path.normpath(path.join(results_dir, run_name))
+    run_names = set(imap(lambda p: p[:-len(PACK_SUFFIX)] if p.endswith(PACK_SUFFIX) else p,
+                         os.listdir(results_dir)))
+    linked = set()
+    for name in run_names:
+        other_dir = path.normpath(path.join(results_dir, name))
+        with RunArchive(other_dir) as other:
+            if other_dir == run_dir or not other.exists():
+                continue
+            for entry in other.entries():
+                entry_path = path.join(other_dir, entry)
+                target = os.readlink(entry_path) if path.islink(entry_path) else other.link_target(entry)
+                if target is not None:
+                    linked.add(path.normpath(path.join(other_dir, target)))
+
+    return sorted(name for name in os.listdir(run_dir)
+                  if path.isdir(path.join(run_dir, name))
+                  and not path.islink(path.join(run_dir, name))
+                  and path.join(run_dir, name) not in linked)
+
+def hash_file(source):
+    """ Compute the SHA-1 of the given file, reading it block by block. The file is given either as a
+        path, or as a pair of a RunArchive and a path relative to its run directory, in which case it
+        may be read from the run's pack.
+        """
+    digest = hashlib.sha1()
+    if isinstance(source, tuple):
+        f = source[0].open(source[1])
+    else:
+        f = open(source, 'rb')
+    with f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class RunDiff:
+    """ Compare two runs in a results directory, step by step. A step that both runs share, i.e. whose
+        directories are one and the same once symlinks are resolved, is skipped entirely. Otherwise,
+        files present in both steps are compared by size, and only if the sizes match, by content
+        hash, hashing up to ``jobs'' files in parallel. Symlinks within steps are compared by target.
+        Archived runs and steps are compared straight from their packs, without unpacking them, and
+        symlinks to previous runs are followed into packs as well.
+        """
+    def __init__(self, results_dir, run_a, run_b, jobs=1):
+        self.results_dir = results_dir
+        self.run_a       = run_a
+        self.run_b       = run_b
+        self.jobs        = jobs
+        self.archives    = {} # maps each run directory looked into to its RunArchive
+
+        for run_name in (self.run_a, self.run_b):
+            if not self._archive(path.join(self.results_dir, run_name)).exists():
+                raise RunDiffError("Run directory not found: %s" % path.join(self.results_dir, run_name))
+
+    def _archive(self, run_dir):
+        """ The RunArchive of the given run directory, so that each pack is opened only once. """
+        run_dir = path.normpath(run_dir)
+        if run_dir not in self.archives:
+            self.archives[run_dir] = RunArchive(run_dir)
+        return self.archives[run_dir]
+
+    def diff(self, out=sys.stdout):
+        """ Print the differences between the two runs to the given file, one step at a time, as soon
+            as each step has been compared. Returns True if the runs differ.
+            """
+        fprint = mkfprint(out)
+        pool = ThreadPool(self.jobs)
+        try:
+            return self._diff(fprint, out, pool)
+        finally:
+            pool.close()
+            pool.join()
+            for archive in self.archives.itervalues():
+                archive.close()
+
+    def _diff(self, fprint, out, pool):
+        steps_a = self._list_steps(self.run_a)
+        steps_b = self._list_steps(self.run_b)
+        differ = False
+        for step_name in sorted(set(steps_a) | set(steps_b)):
+            if step_name not in steps_b:
+                fprint("step %s: only in ``%s''" % (step_name, self.run_a))
+                differ = True
+                continue
+            if step_name not in steps_a:
+                fprint("step %s: only in ``%s''" % (step_name, self.run_b))
+                differ = True
+                continue
+
+            step_a, step_b = self._resolve(steps_a[step_name]), self._resolve(steps_b[step_name])
+            if step_a == step_b:
+                fprint("step %s: shared (%s)" % (step_name, step_a))
+                continue
+            for step_dir in (step_a, step_b):
+                if not self._exists(step_dir):
+                    raise RunDiffError("Step ``%s'' links to ``%s'', which is neither a directory nor "
+                            "archived." % (step_name, step_dir))
+
+            changes = self._diff_step(step_a, step_b, pool)
+            rev_a, rev_b = self._read_rev(step_a), self._read_rev(step_b)
+            if not changes:
+                fprint("step %s: identical (rev %s -> %s)" % (step_name, rev_a, rev_b))
+                continue
+            differ = True
+            fprint("step %s: %i change(s) (rev %s -> %s)" % (step_name, len(changes), rev_a, rev_b))
+            for change, file_path in changes:
+                fprint("  %s %s" % (change, file_path))
+            out.flush()
+        return differ
+
+    def _list_steps(self, run_name):
+        """ Map the name of each step of the given run to the path of its directory. """
+        run_dir = path.join(self.results_dir, run_name)
+        archive = self._archive(run_dir)
+        steps = {}
+        for name in archive.entries():
+            step_dir = path.join(run_dir, name)
+            info = archive.member_info(name)
+            # a dangling link is still a step: it is shared with a run that has since been archived
+            if path.isdir(step_dir) or path.islink(step_dir) or (info is not None
+                    and (info.filename.endswith("/") or archive.link_target(name) is not None)):
+                steps[name] = step_dir
+        return steps
+
+    def _resolve(self, step_dir):
+        """ The real path of the given step directory, following symlinks, including those that were
+            packed along with the run they belong to, as in PipelineRunner._unpack_step.
+            """
+        real_dir = path.realpath(step_dir)
+        for depth in xrange(MAX_LINK_DEPTH):
+            if path.isdir(real_dir):
+                break
+            run_dir, step_name = path.split(real_dir)
+            target = self._archive(run_dir).link_target(step_name)
+            if target is None:
+                break
+            real_dir = path.realpath(path.join(run_dir, target))
+        return real_dir
+
+    def _exists(self, real_dir):
+        """ Whether the given (resolved) step directory exists, either as is or in its run's pack. """
+        if path.isdir(real_dir):
+            return True
+        run_dir, step_name = path.split(real_dir)
+        info = self._archive(run_dir).member_info(step_name)
+        return info is not None and info.filename.endswith("/")
+
+    def _read_rev(self, real_dir):
+        """ The commit recorded in the rev.txt of the run that actually produced the given step. """
+        try:
+            with self._archive(path.dirname(real_dir)).open("rev.txt") as f:
+                lines = [line.strip() for line in f if line.strip()]
+        except (IOError, RunArchiveError):
+            return "unknown"
+        if not lines:
+            return "unknown"
+        return lines[0][:12] + (" (NOT CLEAN)" if "NOT CLEAN" in lines[1:] else "")
+
+    def _list_files(self, real_dir):
+        """ Map the path, relative to the given (resolved) step directory, of each of its files to the
+            pair of its size and source (as expected by hash_file), or for symlinks, to the pair of None
+            and their target.
+            """
+        files = {}
+        if not path.isdir(real_dir): # the step may have been archived
+            run_dir, step_name = path.split(real_dir)
+            archive = self._archive(run_dir)
+            prefix = step_name + "/"
+            for member in archive.members():
+                info = archive.member_info(member)
+                if not member.startswith(prefix) or info.filename.endswith("/"):
+                    continue
+                rel_path = member[len(prefix):]
+                target = archive.link_target(member)
+                if target is not None:
+                    files[rel_path] = (None, target)
+                else:
+                    files[rel_path] = (info.file_size, (archive, member))
+            return files
+
+        for dirpath, dirnames, filenames in os.walk(real_dir):
+            for name in filenames + [d for d in dirnames if path.islink(path.join(dirpath, d))]:
+                file_path = path.join(dirpath, name)
+                rel_path = path.relpath(file_path, real_dir)
+                if path.islink(file_path):
+                    files[rel_path] = (None, os.readlink(file_path))
+                else:
+                    files[rel_path] = (os.stat(file_path).st_size, file_path)
+        return files
+
+    def _diff_step(self, step_a, step_b, pool):
+        """ Compare the files of the two given step directories, returning a sorted list of pairs of a
+            change (``M'' for modified, ``A'' for added, ``D'' for deleted) and a relative path.
+            """
+        files_a = self._list_files(step_a)
+        files_b = self._list_files(step_b)
+        changes = [("D", p) for p in files_a if p not in files_b]
+        changes += [("A", p) for p in files_b if p not in files_a]
+
+        to_hash = []
+        for rel_path in ifilter(lambda p: p in files_b, files_a):
+            (size_a, file_a), (size_b, file_b) = files_a[rel_path], files_b[rel_path]
+            if size_a is None or size_b is None: # at least one is a symlink
+                if (size_a, file_a) != (size_b, file_b):
+                    changes.append(("M", rel_path))
+            elif size_a != size_b:
+                changes.append(("M", rel_path))
+            elif isinstance(file_a, tuple) or isinstance(file_b, tuple) \
+                    or not path.samefile(file_a, file_b):
+                to_hash.append(rel_path)
+
+        hashes = pool.map(hash_file, [files[p][1] for p in to_hash for files in (files_a, files_b)])
+        for (i, rel_path) in enumerate(to_hash):
+            if hashes[2 * i] != hashes[2 * i + 1]:
+                changes.append(("M", rel_path))
+
+        return sorted(changes, key=lambda change: change[1])
+
 def run_reproducible_pipeline(*args, **kwargs):
     """ Construct a PipelineRunner, forwarding all arguments and keyword arguments to its constructor,
         and immediately call its ``run'' method, running the pipeline. The PipelineRunner is returned.
@@ -478,7 +1308,10 @@ switches = {"output_dir":("-o", "--output"), "results_dir":("-R", "--results"),
         "reproducible_file":("-r",), "pipeline_file":("-p",), "range_start":("--from",),
         "range_end":("--to",), "singleton_range":("--only",), "previous_run":("--with",),
         "ignore_missing_output":("--ignore-missing-output",), "final":("--final",),
-        "force":("--force",), "future":("--link-future",)}
+        "force":("--force",), "future":("--link-future",), "jobs":("-j", "--jobs"),
+        "retries":("--retries",), "jobserver":("-J", "--jobserver"), "profile":("--profile",),
+        "profiler":("--profiler",), "diff":("--diff",), "archive":("--archive",),
+        "archive_cold":("--archive-cold",), "unpack":("--unpack",), "cat":("--cat",)}
 
 if __name__ == "__main__":
     results_dir             = "results"
@@ -493,6 +1326,12 @@ if __name__ == "__main__":
     range_end               = None
     previous_run            = None
     inference_behaviour     = None
+    jobs                    = 1
+    retries                 = 0
+    jobserver_spec          = None
+    profiler                = None
+    diff_runs               = None
+    archive_action          = None
 
     seen_args = set()
     saw = lambda name: name in seen_args # convenience for easy-reading
@@ -559,15 +1398,85 @@ if __name__ == "__main__":
             final = True
         elif check_arg("force"):
             force = True
+        elif check_arg("jobs"):
+            jobs = int(nextarg())
+            i += 1
+        elif check_arg("retries"):
+            retries = int(nextarg())
+            i += 1
+        elif check_arg("jobserver"):
+            jobserver_spec = nextarg()
+            i += 1
+        elif check_arg("archive") or check_arg("archive_cold") or check_arg("unpack"):
+            if archive_action:
+                raise CLIError("Only one of ``--archive'', ``--archive-cold'', ``--unpack'' and "
+                        + "``--cat'' can be used at a time.")
+            archive_action = (arg, nextarg())
+            i += 1
+        elif check_arg("cat"):
+            if archive_action:
+                raise CLIError("Only one of ``--archive'', ``--archive-cold'', ``--unpack'' and "
+                        + "``--cat'' can be used at a time.")
+            archive_action = (arg, nextarg(), args[i+2])
+            i += 2
+        elif check_arg("diff"):
+            diff_runs = (nextarg(), args[i+2])
+            i += 2
+        elif check_arg("profile"):
+            if saw("profiler"):
+                raise CLIError("``--profile'' can only be used when ``--profiler'' is not.")
+            profiler = "auto"
+        elif check_arg("profiler"):
+            if saw("profile"):
+                raise CLIError("``--profiler'' can only be used when ``--profile'' is not.")
+            profiler = nextarg()
+            i += 1
         else:
             raise CLIError("Unrecognized command-line options ``%s''." % arg)
         i += 1
 
+    if archive_action is not None:
+        action, run_name = archive_action[:2]
+        archive = RunArchive(path.join(results_dir, run_name))
+        try:
+            if not archive.exists():
+                raise RunArchiveError("Run not found: %s" % archive.run_dir)
+            if action == "--archive":
+                archive.pack()
+                print("Archived run ``%s'' into %s" % (run_name, archive.pack_path))
+            elif action == "--archive-cold":
+                steps = find_cold_steps(results_dir, run_name)
+                if steps:
+                    archive.pack(steps)
+                    print("Archived step(s) %s of run ``%s'' into %s"
+                            % (", ".join(steps), run_name, archive.pack_path))
+                else:
+                    print("Run ``%s'' has no cold steps to archive." % run_name)
+            elif action == "--unpack":
+                archive.unpack()
+            else:
+                with archive.open(archive_action[2]) as f:
+                    shutil.copyfileobj(f, sys.stdout, HASH_BLOCK_SIZE)
+        except (RunArchiveError, IOError, OSError, zipfile.BadZipfile) as e:
+            errprint("The archive operation failed.")
+            errprint(e)
+            exit(1)
+        exit(0)
+
+    if diff_runs is not None:
+        try:
+            differ = RunDiff(results_dir, diff_runs[0], diff_runs[1], jobs).diff()
+        except (RunDiffError, RunArchiveError, IOError, OSError, zipfile.BadZipfile) as e:
+            errprint("The runs could not be compared.")
+            errprint(e)
+            exit(2)
+        exit(1 if differ else 0)
+
     try:
         runner = run_reproducible_pipeline(force, final, output_dir, results_dir,
                     reproducible_file, pipeline_file, range_start, range_end,
                     future, previous_run, ignore_missing_output,
-                    inference_behaviour)
+                    inference_behaviour, jobs, retries, jobserver_spec, profiler)
         with open(path.join(runner.results_dir, runner.output_dir, "invocation.txt"), 'w') as f:
             fprint = mkfprint(f)
             fprint("args =", args[1:])